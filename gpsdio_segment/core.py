@@ -22,7 +22,11 @@ the logic in the function `_compute_best`.
 
 
 from __future__ import division, print_function
+from collections import namedtuple
+import heapq
+import itertools
 import logging
+import operator
 import datetime
 import math
 
@@ -49,6 +53,9 @@ POSITION_TYPES = {
     'VMS' : {'VMS'}
     } 
 
+# Transponder types of messages with a type not in `POSITION_TYPES`
+NO_TRANSPONDER_TYPES = frozenset()
+
 INFO_TYPES = {
     'AIS.5' : 'AIS-A',
     'AIS.19' : 'AIS-B', 
@@ -69,6 +76,19 @@ REPORTED_SPEED_EXCLUSION_RANGES = [(51.15, 51.25), (62.95, 63.05), (102.25,102.3
 SAFE_SPEED = min([x for (x, y) in REPORTED_SPEED_EXCLUSION_RANGES])
 
 
+def is_excluded_speed(speed):
+    """Is `speed` inside one of the `REPORTED_SPEED_EXCLUSION_RANGES`?"""
+    for low, high in REPORTED_SPEED_EXCLUSION_RANGES:
+        if low < speed < high:
+            return True
+    return False
+
+
+def is_null(v):
+    """Is `v` missing, either `None` or NaN?"""
+    return (v is None) or math.isnan(v)
+
+
 POSITION_MESSAGE = object()
 INFO_MESSAGE = object()
 BAD_MESSAGE = object()
@@ -76,6 +96,9 @@ BAD_MESSAGE = object()
 NO_MATCH = object()
 IS_NOISE = object()
 
+# How a message would be added to a segment.
+Match = namedtuple('Match', ['seg_id', 'msgs_to_drop', 'hours', 'metric'])
+
 
 class Segmentizer(DiscrepancyCalculator):
 
@@ -192,6 +215,13 @@ class Segmentizer(DiscrepancyCalculator):
         self._segments = {}
         self._ssvid = ssvid
         self._prev_timestamp = None
+        # Min-heap of `(timestamp_us, seg_id)`, pushed each time a segment gets a
+        # new last message, so stale segments can be found without scanning all
+        # of them. Entries for removed or since-extended segments are skipped
+        # when popped.
+        self._last_us_heap = []
+        # Timestamp of the last message of each open segment in microseconds.
+        self._last_us = {}
         self._discrepancy_alpha_0 = self.max_knots / self.penalty_speed
 
     def __repr__(self):
@@ -216,15 +246,17 @@ class Segmentizer(DiscrepancyCalculator):
                     continue
             seg = Segment.from_state(state)
             s._segments[seg.id] = seg
-            if seg.last_msg:
-                ts = seg.last_msg['timestamp']
+            last_msg = seg.last_msg
+            if last_msg:
+                s._push_last_us(seg, s._timestamp_us(last_msg))
+                ts = last_msg['timestamp']
                 if s._prev_timestamp is None or ts > s._prev_timestamp:
                     s._prev_timestamp = ts
         return s
 
     @staticmethod
     def transponder_types(msg):
-        return POSITION_TYPES.get(msg.get('type'), set())
+        return POSITION_TYPES.get(msg.get('type'), NO_TRANSPONDER_TYPES)
 
 
     @property
@@ -246,27 +278,29 @@ class Segmentizer(DiscrepancyCalculator):
 
         ts = msg['timestamp']
         while True:
-            seg_id = '{}-{:%Y-%m-%dT%H:%M:%S.%fZ}'.format(msg['ssvid'], ts)
+            # Every bad, info and discarded message gets its own segment, so
+            # format the timestamp directly rather than through `strftime`.
+            # This matches '{:%Y-%m-%dT%H:%M:%S.%fZ}' for 4 digit years.
+            seg_id = '%s-%04d-%02d-%02dT%02d:%02d:%02d.%06dZ' % (
+                        msg['ssvid'], ts.year, ts.month, ts.day, 
+                        ts.hour, ts.minute, ts.second, ts.microsecond)
             if seg_id not in self._segments:
                 return seg_id
             ts += datetime.timedelta(milliseconds=1)
 
 
     def _message_type(self, x, y, course, speed):
-        def is_null(v):
-            return (v is None) or math.isnan(v)
         if is_null(x) and is_null(y) and is_null(course) and is_null(speed):
             return INFO_MESSAGE
         if  (x is not None and y is not None and
              speed is not None and course is not None and 
              -180.0 <= x <= 180.0 and 
              -90.0 <= y <= 90.0 and
-             course is not None and 
-             speed is not None and
              ((speed <= self.very_slow and course > 359.95) or
              0.0 <= course <= 359.95) and # 360 is invalid unless speed is very low.
-             (speed < SAFE_SPEED or
-             not any(l < speed < h for (l, h) in REPORTED_SPEED_EXCLUSION_RANGES))):
+             # Almost all speeds are below the exclusion ranges, so only
+             # check the ranges themselves when needed.
+             (speed < SAFE_SPEED or not is_excluded_speed(speed))):
             return POSITION_MESSAGE
         return BAD_MESSAGE
 
@@ -278,12 +312,11 @@ class Segmentizer(DiscrepancyCalculator):
 
     def _remove_excess_segments(self):
         while len(self._segments) >= self.max_open_segments:
-            # Remove oldest segment
-            segs = list(self._segments.items())
-            segs.sort(key=lambda x: x[1].last_msg['timestamp'])
-            stalest_seg_id, _ = segs[0]
+            # Remove oldest segment; of several equally old ones, `min` picks
+            # the one opened first.
+            stalest_seg_id = min(self._segments, key=self._last_us.__getitem__)
             log('Removing stale segment {}'.format(stalest_seg_id))
-            for x in self.clean(self._segments.pop(stalest_seg_id), ClosedSegment):
+            for x in self.clean(self._pop_segment(stalest_seg_id), ClosedSegment):
                 yield x
 
     def _add_segment(self, msg):
@@ -291,61 +324,144 @@ class Segmentizer(DiscrepancyCalculator):
             yield excess_seg
         seg = self._create_segment(msg)
         self._segments[seg.id] = seg
+        self._push_last_us(seg, msg['_features'].timestamp_us)
+
+    def _pop_segment(self, seg_id):
+        """Remove the open segment `seg_id` and return it."""
+        # Segments restored without a last message have no timestamp
+        self._last_us.pop(seg_id, None)
+        return self._segments.pop(seg_id)
+
+    def _push_last_us(self, segment, timestamp_us):
+        self._last_us[segment.id] = timestamp_us
+        heapq.heappush(self._last_us_heap, (timestamp_us, segment.id))
+
+    def _remove_stale_segments(self, timestamp_us):
+        """
+        Finalize and remove any segments that have not had a positional
+        message in `max_hours` as of `timestamp_us`.
+        """
+        heap = self._last_us_heap
+        stale_ids = set()
+        while heap and self.compute_us_delta_hours(heap[0][0], timestamp_us) > self.max_hours:
+            _, seg_id = heapq.heappop(heap)
+            if seg_id not in self._segments:
+                continue
+            last_us = self._last_us[seg_id]
+            if self.compute_us_delta_hours(last_us, timestamp_us) > self.max_hours:
+                stale_ids.add(seg_id)
+        # Close them in the order they were opened
+        if len(stale_ids) > 1:
+            stale_ids = [seg_id for seg_id in self._segments if seg_id in stale_ids]
+        for seg_id in stale_ids:
+            for x in self.clean(self._pop_segment(seg_id), cls=ClosedSegment):
+                yield x
+
 
+    def _features(self, msg):
+        # Messages added during this run carry their features; those restored
+        # from a previous state do not, and must not be modified.
+        features = msg.get('_features')
+        if features is None:
+            features = self.extract_features(msg)
+        return features
 
-    def _segment_match(self, segment, msg):
-        match = {'seg_id': segment.id,
-                 'msgs_to_drop' : [],
-                 'hours' : None,
-                 'metric' : None}
+    def _timestamp_us(self, msg):
+        features = msg.get('_features')
+        if features is None:
+            return self.timestamp_to_us(msg['timestamp'])
+        return features.timestamp_us
+
+    def _segment_match(self, segment, msg, features):
+        """
+        Find the best way to add `msg` to `segment`.
+
+        Returns
+        -------
+        Match or None
+            The match, or `None` if `msg` can't be added to `segment`.
+        """
+        # Bind the parameters used in the loops below to locals
+        lookback_limit = self.lookback
+        penalty_hours = self.penalty_hours
+        penalty_exp = 1 - self.hours_exp
+        max_hours = self.max_hours
+        buffer_hours = self.buffer_hours
+        max_knots = self.max_knots
+        alpha_0 = self._discrepancy_alpha_0
+        lookback_factor = self.lookback_factor
+        mismatch_weight = self.transponder_mismatch_weight
+        timestamp_us = features.timestamp_us
 
         # Get the stats for the last `lookback` positional messages
         candidates = []
 
         n = len(segment)
+        n_lookback = 0
+        expired = False
         msgs_to_drop = []
         metric = 0
         transponder_types = set()
+        get_transponder_types = self.transponder_types
+        # The new message's side of each comparison is fixed, so only the
+        # candidate's features are looked up in the loop.
+        get_features = self._features
+        delta_hours = self.compute_us_delta_hours
+        compute_discrepancy = self._compute_discrepancy
         for prev_msg in segment.get_all_reversed_msgs():
             n -= 1
-            if prev_msg.get('drop'):
-                continue
-            transponder_types |= self.transponder_types(prev_msg)
-            hours = self.compute_msg_delta_hours(prev_msg, msg)
-            penalized_hours = hours / (1 + (hours / self.penalty_hours) ** (1 - self.hours_exp))
-            discrepancy = self.compute_discrepancy(prev_msg, msg, penalized_hours)
-            candidates.append((metric, msgs_to_drop[:], discrepancy, hours, penalized_hours))
-            if len(candidates) >= self.lookback or n < 0:
+            transponder_types |= get_transponder_types(prev_msg)
+            # Candidates are only evaluated below up to the first one more than
+            # `max_hours` old, so past that only the transponder types matter.
+            if not expired:
+                prev_features = get_features(prev_msg)
+                hours = delta_hours(prev_features.timestamp_us, timestamp_us)
+                if hours > max_hours:
+                    # This candidate is rejected below before its discrepancy is
+                    # used, so don't bother computing it.
+                    expired = True
+                    penalized_hours = discrepancy = None
+                else:
+                    penalized_hours = hours / (1 + (hours / penalty_hours) ** penalty_exp)
+                    discrepancy = compute_discrepancy(prev_features, features, penalized_hours)
+                # Candidates share `msgs_to_drop`, so only record how many of
+                # them would be dropped rather than copying the list each time.
+                candidates.append((metric, len(msgs_to_drop), discrepancy, hours, 
+                                   penalized_hours))
+            n_lookback += 1
+            if n_lookback >= lookback_limit or n < 0:
                 # This allows looking back 1 message into the previous batch of messages
                 break
-            msgs_to_drop.append(prev_msg)
-            metric = prev_msg.get('metric', 0)
+            if not expired:
+                msgs_to_drop.append(prev_msg)
+                metric = prev_msg.get('metric', 0)
 
         # Consider transponders matched if the transponder shows up in any of lookback items
         transponder_match = bool(transponder_types & self.transponder_types(msg))
 
         assert len(candidates) > 0
 
+        match = None
         best_metric_lb = 0
         for lookback, match_info in enumerate(candidates):
-            existing_metric, msgs_to_drop, discrepancy, hours, penalized_hours = match_info
+            existing_metric, n_to_drop, discrepancy, hours, penalized_hours = match_info
             assert hours >= 0
-            if hours > self.max_hours: 
+            if hours > max_hours: 
                 log("can't match due to max_hours")
                 # Too long has passed, we can't match this segment
                 break
             else:
-                padded_hours = math.hypot(hours, self.buffer_hours)
-                max_allowed_discrepancy = padded_hours * self.max_knots
+                padded_hours = math.hypot(hours, buffer_hours)
+                max_allowed_discrepancy = padded_hours * max_knots
                 if discrepancy <= max_allowed_discrepancy:
-                    alpha = self._discrepancy_alpha_0 * discrepancy / max_allowed_discrepancy 
+                    alpha = alpha_0 * discrepancy / max_allowed_discrepancy 
                     metric = math.exp(-alpha ** 2) / padded_hours #** 2
                     # Down weight cases where transceiver types don't match.
                     if not transponder_match:
-                        metric *= self.transponder_mismatch_weight
+                        metric *= mismatch_weight
                     # For lookback use the weight reduced by the lookback factor,
                     # But don't store this weight, use base metric instead.
-                    metric_lb = metric / max(1, lookback * self.lookback_factor)
+                    metric_lb = metric / max(1, lookback * lookback_factor)
                     # Scale the existing metric using the lookback factor so that we only
                     # matches to points further in the past if they are noticeably better
                     if metric_lb <= existing_metric:
@@ -356,9 +472,7 @@ class Segmentizer(DiscrepancyCalculator):
                     if metric_lb > best_metric_lb:
                         log('updating metric %s (%s)', metric_lb, metric)
                         best_metric_lb = metric_lb
-                        match['metric'] = metric
-                        match['hours'] = hours
-                        match['msgs_to_drop'] = msgs_to_drop
+                        match = Match(segment.id, msgs_to_drop[:n_to_drop], hours, metric)
                 else:
                     log("can't match due to discrepancy: %s / %s = %s", 
                             discrepancy, padded_hours, discrepancy / padded_hours)
@@ -366,41 +480,54 @@ class Segmentizer(DiscrepancyCalculator):
 
         return match
 
-    def _compute_best(self, msg):
+    def _compute_best(self, msg, features):
         # figure out which segment is the best match for the given message
 
-        segs = list(self._segments.values())
         best_match = NO_MATCH
 
-        # get match metrics for all candidate segments
-        raw_matches = [self._segment_match(seg, msg) for seg in segs]
-        # If metric is none, then the segment is not a match candidate
-        matches = [x for x in raw_matches if x['metric'] is not None]
-
-        if len(matches) == 1:
-            # This is the most common case, so make it optimal
-            # and avoid all the messing around with lists in the num_segs > 1 case
-            [best_match] = matches
-        elif len(matches) > 1:
-            # Down-weight (decrease metric) for short segments
-            valid_segs = [s for s, m in zip(segs, raw_matches) if m is not None]
-            alphas = [s.msg_count / self.short_seg_threshold for s in valid_segs]
-            metric_match_pairs = [(m['metric'] * a / math.sqrt(1 + a**2), m) 
-                                    for (m, a) in zip(matches, alphas)]
-            metric_match_pairs.sort(key=lambda x: x[0], reverse=True)
-            # Check if best match is close enough to an existing match to be ambiguous.
-            best_metric, best_match = metric_match_pairs[0]
-            close_matches = [best_match]
-            for metric, match in metric_match_pairs[1:]:
-                if metric * self.ambiguity_factor >= best_metric:
-                    close_matches.append(match)
-            if len(close_matches) > 1:
-                log('Ambiguous messages for id {}'.format(msg['ssvid']))
-                best_match = close_matches
+        if len(self._segments) == 1:
+            # Only one segment is open, which is the most common case, so
+            # skip building and weighing a list of matches.
+            [seg] = self._segments.values()
+            match = self._segment_match(seg, msg, features)
+            if match is not None:
+                best_match = match
+        else:
+            # get match metrics for all candidate segments, skipping the
+            # segments `msg` can't be added to.
+            matches = []
+            for seg in self._segments.values():
+                match = self._segment_match(seg, msg, features)
+                if match is not None:
+                    matches.append(match)
+
+            if len(matches) == 1:
+                # Only one segment matched, so there's nothing to weigh it against
+                [best_match] = matches
+            elif len(matches) > 1:
+                # Down-weight (decrease metric) for short segments. Note that the
+                # weights are paired with `matches` by position among all open
+                # segments, not by the segment each match belongs to.
+                short_seg_threshold = self.short_seg_threshold
+                metric_match_pairs = []
+                for m, s in zip(matches, self._segments.values()):
+                    a = s.msg_count / short_seg_threshold
+                    metric_match_pairs.append((m.metric * a / math.sqrt(1 + a**2), m))
+                metric_match_pairs.sort(key=operator.itemgetter(0), reverse=True)
+                # Check if best match is close enough to an existing match to be ambiguous.
+                best_metric, best_match = metric_match_pairs[0]
+                ambiguity_factor = self.ambiguity_factor
+                close_matches = [best_match]
+                for metric, match in itertools.islice(metric_match_pairs, 1, None):
+                    if metric * ambiguity_factor >= best_metric:
+                        close_matches.append(match)
+                if len(close_matches) > 1:
+                    log('Ambiguous messages for id {}'.format(msg['ssvid']))
+                    best_match = close_matches
 
         if best_match is not NO_MATCH:
-            hours = (min([x['hours'] for x in best_match]) 
-                        if isinstance(best_match, list) else best_match['hours'])
+            hours = (min([x.hours for x in best_match]) 
+                        if isinstance(best_match, list) else best_match.hours)
             if  msg.get('type') == 'AIS.27' and hours < self.min_type_27_hours:
                 # Type 27 messages have low resolution, so only include them where there likely to 
                 # not mess up the tracks
@@ -419,6 +546,7 @@ class Segmentizer(DiscrepancyCalculator):
         for msg in segment.msgs:
             self.add_info(msg)
             msg.pop('metric', None)
+            msg.pop('_features', None)
             if msg.pop('drop', False):
                 log(("Dropping message from ssvid: {ssvid!r} timestamp: {timestamp!r}").format(
                     **msg))
@@ -531,7 +659,7 @@ class Segmentizer(DiscrepancyCalculator):
                 raise ValueError("Message missing timestamp") 
             if self._prev_timestamp is not None and timestamp < self._prev_timestamp:
                 raise ValueError("Input data is unsorted")
-            self._prev_timestamp = msg['timestamp']
+            self._prev_timestamp = timestamp
 
             msgid = msg.get('msgid')
             if msgid in self.prev_msgids or msgid in self.cur_msgids:
@@ -574,44 +702,47 @@ class Segmentizer(DiscrepancyCalculator):
                 continue
             self.cur_locations[loc] = timestamp
 
-            if len(self._segments) == 0:
+            # Stored on the message so later matches against it can reuse them.
+            # Removed again in `clean()`.
+            msg['_features'] = features = self.make_features(x, y, course, speed, timestamp)
+
+            if not self._segments:
                 log("adding new segment because no current segments")
                 for x in self._add_segment(msg):
                     yield x
             else:
-                # Finalize and remove any segments that have not had a positional message in `max_hours`
-                for segment in list(self._segments.values()):
-                    if (self.compute_msg_delta_hours(segment.last_msg, msg) > self.max_hours):
-                            for x in self.clean(self._segments.pop(segment.id), cls=ClosedSegment):
-                                yield x
+                for x in self._remove_stale_segments(features.timestamp_us):
+                    yield x
 
-                best_match = self._compute_best(msg)
+                best_match = self._compute_best(msg, features)
                 if best_match is NO_MATCH:
                     log("adding new segment because no match")
                     for x in self._add_segment(msg):
                         yield x
                 elif best_match is IS_NOISE:
+                    del msg['_features']
                     yield self._create_segment(msg, cls=BadSegment)
                 elif isinstance(best_match, list):
                     # This message could match multiple segments. 
                     # So finalize and remove ambiguous segments so we can start fresh
                     # TODO: once we are fully py3, this and similar can be cleaned up using `yield from`
                     for match in best_match:
-                        for x in self.clean(self._segments.pop(match['seg_id']), cls=ClosedSegment):
+                        for x in self.clean(self._pop_segment(match.seg_id), cls=ClosedSegment):
                             yield x
                     # Then add as new segment.
                     log("adding new segment because of ambiguity with {} segments".format(len(best_match)))
                     for x in self._add_segment(msg):
                         yield x
                 else:
-                    id_ = best_match['seg_id']
-                    for msg_to_drop in best_match['msgs_to_drop']:
+                    id_ = best_match.seg_id
+                    for msg_to_drop in best_match.msgs_to_drop:
                         msg_to_drop['drop'] = True
-                    msg['metric'] = best_match['metric']
+                    msg['metric'] = best_match.metric
                     self._segments[id_].add_msg(msg)
+                    self._push_last_us(self._segments[id_], features.timestamp_us)
 
 
         for series, segment in list(self._segments.items()):
-            for x in self.clean(self._segments.pop(segment.id), Segment):
+            for x in self.clean(self._pop_segment(segment.id), Segment):
                 yield x
 
@@ -1,7 +1,30 @@
+from collections import namedtuple
+import datetime
 import math
 
 inf = float("inf")
 
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# The flat-earth approximation below uses fixed conversion factors, so
+# evaluate them once here rather than on every comparison.
+DEG_TO_RAD = math.pi / 180
+NM_PER_DEG_LAT = 60.0
+DEG_LAT_PER_NM = 1.0 / NM_PER_DEG_LAT
+EPSILON = 1e-3
+
+
+# Fields of a positional message used when matching it against other messages.
+# `drift_speed` is the speed used to extrapolate the position, which is zero
+# when the course is unavailable. `course_rad` is the course converted to
+# the math convention (0 pointing east, counter-clockwise) in radians, and
+# `cos_course`, `sin_course` and `deg_lon_per_nm` are derived from it and the
+# latitude. `timestamp_us` is the message timestamp in integer microseconds
+# since `EPOCH`.
+Features = namedtuple('Features', ['lon', 'lat', 'speed', 'drift_speed', 
+                                   'course_rad', 'cos_course', 'sin_course',
+                                   'deg_lon_per_nm', 'timestamp_us'])
+
 
 class DiscrepancyCalculator(object):
     """Base class that supplies discrepancy calculator"""
@@ -41,29 +64,59 @@ class DiscrepancyCalculator(object):
         ts2 = msg2['timestamp']
         return DiscrepancyCalculator.compute_ts_delta_hours(ts1, ts2)
 
+    @staticmethod
+    def timestamp_to_us(ts):
+        """Convert a `datetime.datetime()` to integer microseconds since `EPOCH`.
+
+        Differences between these values are exact, so `compute_us_delta_hours`
+        matches `compute_ts_delta_hours` without any `datetime` arithmetic.
+        """
+        delta = ts.replace(tzinfo=None) - EPOCH
+        offset = ts.utcoffset()
+        if offset is not None:
+            delta -= offset
+        return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+    @staticmethod
+    def compute_us_delta_hours(us1, us2):
+        return (us2 - us1) / 1e6 / 3600
+
     @classmethod
-    def _compute_expected_position(cls, msg, hours):
-        epsilon = 1e-3
-        x = msg['lon']
-        y = msg['lat']
-        speed = msg['speed']
-        course = msg['course']
+    def extract_features(cls, msg):
+        """Pull the fields used when computing discrepancies out of `msg`.
+
+        Matching compares each new message against several earlier ones, so
+        callers can extract these once per message and reuse the result.
+
+        Returns
+        -------
+        Features
+        """
+        return cls.make_features(msg['lon'], msg['lat'], msg['course'], msg['speed'],
+                                 msg['timestamp'])
+
+    @classmethod
+    def make_features(cls, lon, lat, course, speed, timestamp):
+        """Same as `extract_features`, for values already read from a message.
+
+        Returns
+        -------
+        Features
+        """
+        drift_speed = speed
         if course > 359.95:
             assert speed <= cls.very_slow, (course, speed)
-            speed = 0
-        # Speed is in knots, so `dist` is in nautical miles (nm)
-        dist = speed * hours 
+            drift_speed = 0
         # Course is assumed to have `0` pointing north and positive
         # is clockwise as is reported by AIS. This in contrast with
         # the natural math based definition which has 0 pointing east
         # and positive being counter-clockwise, so we switch to that
         # here.
-        course = math.radians(90.0 - course)
-        deg_lat_per_nm = 1.0 / 60
-        deg_lon_per_nm = deg_lat_per_nm / (math.cos(math.radians(y)) + epsilon)
-        dx = math.cos(course) * dist * deg_lon_per_nm
-        dy = math.sin(course) * dist * deg_lat_per_nm
-        return x + dx, y + dy
+        course_rad = (90.0 - course) * DEG_TO_RAD
+        deg_lon_per_nm = DEG_LAT_PER_NM / (math.cos(lat * DEG_TO_RAD) + EPSILON)
+        return Features(lon, lat, speed, drift_speed, 
+                        course_rad, math.cos(course_rad), math.sin(course_rad),
+                        deg_lon_per_nm, cls.timestamp_to_us(timestamp))
 
     def compute_discrepancy(self, msg1, msg2, hours=None):
 
@@ -74,7 +127,7 @@ class DiscrepancyCalculator(object):
 
         Returns
         -------
-        dict
+        float
         """
 
         if hours is None:
@@ -88,48 +141,63 @@ class DiscrepancyCalculator(object):
         y2 = msg2.get('lat')
 
         if (x2 is None or y2 is None):
-            distance = None
-            speed = None
-            discrepancy = None
-        else:
-            x2p, y2p = self._compute_expected_position(msg1, hours)
-            x1p, y1p = self._compute_expected_position(msg2, -hours)
-
-            def wrap(x):
-                return (x + 180) % 360 - 180
-
-            nm_per_deg_lat = 60.0
-            y = 0.5 * (y1 + y2)
-            epsilon = 1e-3
-            nm_per_deg_lon = nm_per_deg_lat  * math.cos(math.radians(y))
-            discrepancy1 = 0.5 * (
-                math.hypot(nm_per_deg_lon * wrap(x1p - x1) , 
-                           nm_per_deg_lat * (y1p - y1)) + 
-                math.hypot(nm_per_deg_lon * wrap(x2p - x2) , 
-                           nm_per_deg_lat * (y2p - y2)))
-
-            # Vessel just stayed put
-            dist = math.hypot(nm_per_deg_lat * (y2 - y1), 
-                              nm_per_deg_lon * wrap(x2 - x1))
-            discrepancy2 = dist * self.shape_factor
-
-            # Distance perp to line
-            rads21 = math.atan2(nm_per_deg_lat * (y2 - y1), 
-                                nm_per_deg_lon * wrap(x2 - x1))
-            delta21 = math.radians(90 - msg1['course']) - rads21
+            return None
+        return self._compute_discrepancy(self.extract_features(msg1), 
+                                         self.extract_features(msg2), hours)
+
+    def _compute_discrepancy(self, features1, features2, hours):
+        """
+        Same as `compute_discrepancy`, but working on the output of
+        `extract_features` for two positional messages.
+        """
+        (x1, y1, speed1, drift_speed1, course_rad1, 
+            cos_course1, sin_course1, deg_lon_per_nm1, _) = features1
+        (x2, y2, speed2, drift_speed2, course_rad2, 
+            cos_course2, sin_course2, deg_lon_per_nm2, _) = features2
+
+        # Expected positions of each message extrapolated to the other's time.
+        # Speed is in knots, so `dist` is in nautical miles (nm)
+        dist1 = drift_speed1 * hours
+        x2p = x1 + cos_course1 * dist1 * deg_lon_per_nm1
+        y2p = y1 + sin_course1 * dist1 * DEG_LAT_PER_NM
+        dist2 = drift_speed2 * -hours
+        x1p = x2 + cos_course2 * dist2 * deg_lon_per_nm2
+        y1p = y2 + sin_course2 * dist2 * DEG_LAT_PER_NM
+
+        nm_per_deg_lat = NM_PER_DEG_LAT
+        y = 0.5 * (y1 + y2)
+        nm_per_deg_lon = nm_per_deg_lat  * math.cos(y * DEG_TO_RAD)
+        # Longitude differences are wrapped into [-180, 180) inline, since
+        # this runs for every candidate message.
+        discrepancy1 = 0.5 * (
+            math.hypot(nm_per_deg_lon * ((x1p - x1 + 180) % 360 - 180) , 
+                       nm_per_deg_lat * (y1p - y1)) + 
+            math.hypot(nm_per_deg_lon * ((x2p - x2 + 180) % 360 - 180) , 
+                       nm_per_deg_lat * (y2p - y2)))
+
+        # Vessel just stayed put
+        dy21 = nm_per_deg_lat * (y2 - y1)
+        dx21 = nm_per_deg_lon * ((x2 - x1 + 180) % 360 - 180)
+        dist = math.hypot(dy21, dx21)
+        shape_factor = self.shape_factor
+        discrepancy2 = dist * shape_factor
+
+        # Distance perp to line. This is infinite unless the line lies ahead
+        # of both messages within their reported speeds, so only compute the
+        # angles and normals as far as needed to tell.
+        discrepancy3 = inf
+        max_tangential21 = speed1 * hours
+        max_tangential12 = speed2 * hours
+        if max_tangential21 > 0 and max_tangential12 > 0:
+            rads21 = math.atan2(dy21, dx21)
+            delta21 = course_rad1 - rads21
             tangential21 = math.cos(delta21) * dist
-            if 0 < tangential21 <= msg1['speed'] * hours:
-                normal21 = abs(math.sin(delta21)) * dist
-            else:
-                normal21 = inf
-            delta12 = math.radians(90 - msg2['course']) - rads21 
-            tangential12 = math.cos(delta12) * dist
-            if 0 < tangential12 <= msg2['speed'] * hours:
-                normal12 = abs(math.sin(delta12)) * dist
-            else:
-                normal12 = inf
-            discrepancy3 = 0.5 * (normal12 + normal21) * self.shape_factor
-
-            discrepancy = min(discrepancy1, discrepancy2, discrepancy3)
-
-        return discrepancy
\ No newline at end of file
+            if 0 < tangential21 <= max_tangential21:
+                delta12 = course_rad2 - rads21
+                tangential12 = math.cos(delta12) * dist
+                if 0 < tangential12 <= max_tangential12:
+                    normal21 = abs(math.sin(delta21)) * dist
+                    normal12 = abs(math.sin(delta12)) * dist
+                    discrepancy3 = 0.5 * (normal12 + normal21) * shape_factor
+
+        return min(discrepancy1, discrepancy2, discrepancy3)
@@ -20,7 +20,8 @@ class Segment(object):
     Contains all the messages that have been deemed by the `Segmentizer()` to
     be continuous.
     """
-    __slots__ = ['id', 'ssvid', 'msgs', 'prev_state', 'prev_segment', 'msgs']
+    __slots__ = ['id', 'ssvid', 'msgs', 'prev_state', 'prev_segment', 
+                 '_prev_msg_count']
 
     noise = False # This isn't a 'real' segment, so it isn't written to a table
     closed = False # No more segments should be written to this segment
@@ -41,6 +42,8 @@ class Segment(object):
         self.prev_state = None
         self.prev_segment = None
         self.msgs = []
+        # Messages counted in `prev_state`, so `msg_count` needs no lookups
+        self._prev_msg_count = 0
 
     @classmethod
     def from_state(cls, state):
@@ -59,6 +62,7 @@ class Segment(object):
         seg = cls(state.id, state.ssvid)
         # Note that _noise and _closed come from the state
         seg.prev_state = state
+        seg._prev_msg_count = state.msg_count
         seg.prev_segment = Segment(state.id, state.ssvid)
         seg.prev_segment.add_msg(state.first_msg)
         seg.prev_segment.add_msg(state.last_msg)
@@ -103,15 +107,13 @@ class Segment(object):
 
     @property
     def msg_count(self):
-        n = len(self.msgs)
-        if self.prev_state:
-            n += self.prev_state.msg_count
-        return n
+        return len(self.msgs) + self._prev_msg_count
 
     def get_all_reversed_msgs(self):
         source = self
         while source is not None:
-            for msg in source.msgs[::-1]:
+            # Callers usually stop after a few messages, so don't copy `msgs`
+            for msg in reversed(source.msgs):
                 if not msg.get('drop', False):
                     yield msg
             source = source.prev_segment
@@ -156,12 +158,16 @@ class ClosedSegment(Segment):
     Segment that has timed out or closed because of ambiguity
     so we don't want to feed it back into Segmentizer
     """
+    __slots__ = ()
+
     closed = True
 
 class NoiseSegment(ClosedSegment):
     """
     Segment that doesn't represent a real 'segment' for some reason.
     """
+    __slots__ = ()
+
     noise = True
 
 class BadSegment(NoiseSegment):
@@ -171,17 +177,20 @@ class BadSegment(NoiseSegment):
     away we stick it into a `BadSegment()` so the user can filter with an
     instance check.
     """
+    __slots__ = ()
 
 class DiscardedSegment(NoiseSegment):
     """
     Points that are discarded during post processing of segments are emitted as 
     Discarded segments.
     """
+    __slots__ = ()
 
 class InfoSegment(NoiseSegment):
     """
     Info messages that aren't matched to segments.
     """
+    __slots__ = ()
 
 
 
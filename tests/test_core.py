@@ -8,6 +8,7 @@ from __future__ import division
 import datetime
 
 import pytest
+import pytz
 
 import gpsdio_segment.core
 
@@ -90,3 +91,39 @@ def test_last_msg_combinations():
     seg.add_msg(time_posit)
     seg.add_msg(non_posit)
     assert seg.last_msg == non_posit
+
+
+def _far_apart_msgs(minutes):
+    # Each message is 20 degrees of longitude from the others, so none of them
+    # can match and every one opens its own segment.
+    t0 = datetime.datetime(2018, 1, 1, tzinfo=pytz.utc)
+    return [{'ssvid': 1, 'msgid': i, 'type': 'AIS.1', 'lat': 0, 'lon': -170 + 20 * i,
+             'course': 0, 'speed': 0, 'timestamp': t0 + datetime.timedelta(minutes=m)}
+            for (i, m) in enumerate(minutes)]
+
+
+def _closed_msgids(segments):
+    return [[msg['msgid'] for msg in seg] for seg in segments
+                if type(seg) is gpsdio_segment.core.ClosedSegment]
+
+
+def test_remove_excess_segments_closes_oldest():
+    msgs = _far_apart_msgs([0, 1, 2, 3, 4])
+    segments = list(gpsdio_segment.core.Segmentizer(msgs, max_open_segments=3))
+    # Opening the 4th and 5th segments closes the two oldest ones
+    assert _closed_msgids(segments) == [[0], [1]]
+    assert len(segments) == 5
+
+
+def test_remove_excess_segments_tie_closes_first_opened():
+    # Messages 0 and 1 share a timestamp, so their segments are equally old
+    msgs = _far_apart_msgs([0, 0, 1, 2])
+    segments = list(gpsdio_segment.core.Segmentizer(msgs, max_open_segments=3))
+    assert _closed_msgids(segments) == [[0]]
+
+    # Segment 0 gets a newer message, leaving segments 1 and 2 tied as oldest
+    msgs = _far_apart_msgs([0, 1, 1, 3])
+    extend = dict(msgs[0], msgid=4, timestamp=msgs[0]['timestamp'] + datetime.timedelta(minutes=2))
+    msgs.insert(3, extend)
+    segments = list(gpsdio_segment.core.Segmentizer(msgs, max_open_segments=3))
+    assert _closed_msgids(segments) == [[1]]
@@ -6,6 +6,8 @@ Unittests for specific segmentation rules.
 from datetime import datetime
 from datetime import timedelta
 
+import pytz
+
 from gpsdio_segment.core import Segmentizer
 from support import utcify
 
@@ -63,6 +65,38 @@ def test_good_speed_good_time():
         assert len(seg) == 2
 
 
+def test_us_delta_hours_matches_ts_delta_hours():
+    # Matching uses integer microsecond timestamps, which must give exactly
+    # the same hours as subtracting the datetimes
+    t0 = datetime(2018, 1, 1, 12, 30, 15, 123456)
+    east = pytz.FixedOffset(330)
+    west = pytz.FixedOffset(-300)
+    pairs = [
+        # sub-second
+        (t0, t0 + timedelta(microseconds=1)),
+        (t0, t0 + timedelta(seconds=0.999999)),
+        # multi-day
+        (t0, t0 + timedelta(days=3, hours=7, microseconds=654321)),
+        (t0, t0 + timedelta(days=400, seconds=1)),
+        # tz-aware UTC
+        (pytz.utc.localize(t0), pytz.utc.localize(t0 + timedelta(minutes=17, microseconds=5))),
+        # non-zero UTC offsets, including timestamps in different zones
+        (east.localize(t0), east.localize(t0 + timedelta(hours=2))),
+        (pytz.utc.localize(t0), west.localize(t0)),
+        (east.localize(t0), west.localize(t0 + timedelta(seconds=0.5))),
+    ]
+    for ts1, ts2 in pairs:
+        us1 = Segmentizer.timestamp_to_us(ts1)
+        us2 = Segmentizer.timestamp_to_us(ts2)
+        assert (Segmentizer.compute_us_delta_hours(us1, us2) == 
+                Segmentizer.compute_ts_delta_hours(ts1, ts2))
+    # The offset is applied, so the same instant gives the same value in any zone
+    instant = pytz.utc.localize(t0)
+    assert (Segmentizer.timestamp_to_us(instant) == 
+            Segmentizer.timestamp_to_us(instant.astimezone(east)) ==
+            Segmentizer.timestamp_to_us(instant.astimezone(west)))
+
+
 # TODO: add tests of new segmenter rules
 
 